@@ -2,117 +2,401 @@
 # https://github.com/replicate/cog/blob/main/docs/python.md
 
 import asyncio
+import itertools
 import json
 import os
+import re
+import shutil
 import subprocess
 import tempfile
+from collections import OrderedDict
 from typing import Optional
-from zipfile import ZipFile
+from zipfile import ZIP_STORED, ZipFile
 
+import aiofiles
 import aiohttp
+from PIL import Image
 from cog import BaseModel, BasePredictor, Input, Path
 
 if __name__ == '__main__':
   def Input(default=None, **kwargs):
     return default
 
+# Cap in-flight downloads so huge URL lists don't open hundreds of sockets
+MAX_CONCURRENT_DOWNLOADS = 16
+
+
+class UrlCache:
+    """Disk-backed LRU of downloaded URLs, reused across predictions"""
+
+    def __init__(self, max_bytes=2 * 1024**3):
+        self.max_bytes = max_bytes
+        self.cache_dir = tempfile.mkdtemp(prefix="url-cache-")
+        self._counter = itertools.count()
+        self._entries = OrderedDict()  # url -> (cached path, size in bytes)
+        self._total_bytes = 0
+
+    def get(self, url, dest_path):
+        """Hard-link a cached download to dest_path; returns False on miss"""
+        entry = self._entries.get(url)
+        if entry is None:
+            return False
+        try:
+            os.link(entry[0], dest_path)
+        except OSError:
+            return False
+        self._entries.move_to_end(url)
+        return True
+
+    def put(self, url, src_path):
+        if url in self._entries:
+            return
+        cached_path = os.path.join(self.cache_dir, str(next(self._counter)))
+        try:
+            size = os.path.getsize(src_path)
+            os.link(src_path, cached_path)
+        except OSError:
+            return
+        self._entries[url] = (cached_path, size)
+        self._total_bytes += size
+        while self._total_bytes > self.max_bytes:
+            _, (old_path, old_size) = self._entries.popitem(last=False)
+            os.unlink(old_path)
+            self._total_bytes -= old_size
+
+
 class Output(BaseModel):
     video: Path
     zip: Optional[Path]
 
 
-async def is_valid_url(session, url):
+async def download_and_save_image(session, sem, url, temp_dir, frame_number, url_cache=None):
     try:
-        async with session.head(url) as response:
-            response.raise_for_status()
-            return True
-    except aiohttp.ClientError:
-        return False
+        # Fixed zero-padded name in the specified directory; keeping the
+        # extension uniform means every frame reaches ffmpeg regardless of
+        # what the URL path looked like, and numeric sort matches frame order
+        temp_file_path = f"{temp_dir}/frame_{frame_number:06d}.png"
 
+        # Repeat URLs resolve to a hard link of the cached download
+        if url_cache is not None and url_cache.get(url, temp_file_path):
+            return temp_file_path
 
-async def download_and_save_image(session, url, temp_dir, frame_number):
-    try:
-        async with session.get(url) as response:
-            response.raise_for_status()
-            image_data = await response.read()
-
-            # Use tempfile to create a temporary file in the specified directory
-            _, file_extension = os.path.splitext(url)
-            temp_file_name = f"frame_{frame_number}{file_extension}"
-            temp_file_path = os.path.join(temp_dir, temp_file_name)
-
-            # Save the image to the temporary file
-            with open(temp_file_path, "wb") as f:
-                f.write(image_data)
+        async with sem, session.get(url) as response:
+            # Stream the image to the temporary file chunk by chunk, so peak
+            # memory per download is one chunk rather than the whole image
+            async with aiofiles.open(temp_file_path, "wb") as f:
+                async for chunk in response.content.iter_chunked(65536):
+                    await f.write(chunk)
 
+            if url_cache is not None:
+                url_cache.put(url, temp_file_path)
             return temp_file_path
     except aiohttp.ClientError as e:
         print(f"Error downloading image from {url}: {e}")
         return None
 
 
-async def save_images(image_urls):
+def iter_urls(image_urls):
+    """Yield stripped URLs from the comma-separated input without
+    materializing a list of all fragments up front"""
+    return (match.group().strip() for match in re.finditer(r"[^,]+", image_urls))
+
+
+async def save_images(session, image_urls, temp_dir, url_cache=None):
     try:
-        async with aiohttp.ClientSession() as session:
-            # Create a temporary directory
-            temp_dir = tempfile.mkdtemp()
-
-            # Check if all elements in the list are valid URLs and download/save images
-            tasks = [
-                download_and_save_image(session, url, temp_dir, frame_number)
-                for frame_number, url in enumerate(image_urls)
-                if await is_valid_url(session, url)
-            ]
-            print(image_urls)
+        # A bad URL just fails its GET and is dropped below, so no separate
+        # validation pass; image_urls may be any iterable, consumed once
+        sem = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+        tasks = [
+            download_and_save_image(
+                session, sem, url, temp_dir, frame_number, url_cache=url_cache
+            )
+            for frame_number, url in enumerate(image_urls)
+        ]
 
-            saved_images = await asyncio.gather(*tasks)
+        saved_images = await asyncio.gather(*tasks)
+        # Failed downloads return None; drop them
+        saved_images = [path for path in saved_images if path is not None]
 
-            return saved_images, temp_dir
+        return saved_images
 
     except (ValueError, json.JSONDecodeError) as e:
         print(f"Error parsing JSON string: {e}")
-        return None, None
+        return None
 
 
-def create_animated_media(images, output_filename, fps, mp4=False):
-    try:
-        # Use ffmpeg to create an animated gif or video from the images
-        command = [
-            "ffmpeg",
-            "-r",
-            str(fps),
-            "-pattern_type",
-            "glob",
-            "-i",
-            os.path.join(os.path.dirname(images[0]), "frame_*.png"),
-        ]
+def decode_to_rgb(path):
+    """Decode an image file to raw RGB bytes plus its (width, height)"""
+    with Image.open(path) as image:
+        rgb = image.convert("RGB")
+        return rgb.tobytes(), rgb.size
+
 
-        if mp4:
-            command += [
+async def save_images_and_encode(session, image_urls, temp_dir, output_filename, fps, video_encoders, url_cache=None, threads=None):
+    """Download frames and pipe them into ffmpeg in order as they complete,
+    so mp4 encoding overlaps with the tail of the downloads. Frames are
+    decoded to raw RGB in Python so ffmpeg skips its own image decode."""
+    sem = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    tasks = [
+        asyncio.ensure_future(
+            download_and_save_image(
+                session, sem, url, temp_dir, frame_number, url_cache=url_cache
+            )
+        )
+        for frame_number, url in enumerate(image_urls)
+    ]
+
+    proc = None
+    frame_size = None
+    saved_images = []
+    encode_failed = False
+    for task in tasks:
+        path = await task
+        if path is None:
+            continue
+        saved_images.append(path)
+        if encode_failed:
+            continue
+        try:
+            rgb, size = await asyncio.to_thread(decode_to_rgb, path)
+        except (OSError, ValueError):
+            encode_failed = True
+            continue
+        if proc is None:
+            # The first frame fixes the rawvideo geometry
+            frame_size = size
+            encoder = video_encoders[0]
+            command = [
+                "ffmpeg",
+                "-loglevel",
+                "error",
+                "-nostats",
+                "-f",
+                "rawvideo",
+                "-pix_fmt",
+                "rgb24",
+                "-s",
+                f"{size[0]}x{size[1]}",
+                "-r",
+                str(fps),
+                "-i",
+                "-",
                 "-pix_fmt",
                 "yuv420p",
                 "-c:v",
-                "libx264",
+                encoder,
                 "-movflags",
                 "faststart",
-                "-qp",
-                "17",
             ]
+            command += MP4_ENCODER_ARGS.get(encoder, [])
+            if threads:
+                command += ["-threads", str(threads)]
+            command += ["-y", output_filename]
+            proc = await asyncio.create_subprocess_exec(
+                *command, stdin=asyncio.subprocess.PIPE
+            )
+        elif size != frame_size:
+            # Mixed frame sizes; let the caller re-encode from the files
+            encode_failed = True
+            continue
+        try:
+            proc.stdin.write(rgb)
+            await proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg died (e.g. unsupported encoder); keep downloading so the
+            # caller can re-encode from the saved frames
+            encode_failed = True
+    if proc is not None:
+        if encode_failed:
+            proc.kill()
         else:
-            command += ["-pix_fmt", "rgb8"]
+            proc.stdin.close()
+        await proc.wait()
+
+    encoded = proc is not None and not encode_failed and proc.returncode == 0
+    return saved_images, encoded
+
+
+def write_zip(zip_filename, saved_images):
+    # Store the already-compressed images as-is; deflating PNG/JPEG again
+    # costs CPU for no size win. For big batches, the external zip tool
+    # avoids CPython's per-file zipfile overhead
+    if len(saved_images) > 32:
+        try:
+            subprocess.run(
+                ["zip", "-q", "-0", "-j", zip_filename, *saved_images],
+                check=True,
+            )
+            return
+        except (subprocess.CalledProcessError, OSError):
+            pass
+    with ZipFile(zip_filename, "w", compression=ZIP_STORED) as zip:
+        for file_path in saved_images:
+            zip.write(file_path, arcname=os.path.basename(file_path))
+
 
-        command += [output_filename]
-        subprocess.check_output(command)
+def run_ffmpeg(command):
+    """Run ffmpeg discarding stdout and keeping only failure diagnostics,
+    so verbose encoder output doesn't back up the pipe to the parent"""
+    subprocess.run(
+        command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+
+
+def probe_h264_encoders():
+    """Return the usable H.264 encoders, fastest first, ending with libx264"""
+    try:
+        output = subprocess.check_output(
+            ["ffmpeg", "-hide_banner", "-encoders"], stderr=subprocess.DEVNULL
+        ).decode()
+    except (subprocess.CalledProcessError, OSError):
+        output = ""
+    encoders = [
+        name
+        for name in ("h264_nvenc", "h264_qsv", "h264_vaapi")
+        if name in output
+    ]
+    encoders.append("libx264")
+    return encoders
+
+
+# Encoder-specific quality/speed flags for the mp4 path
+MP4_ENCODER_ARGS = {
+    "h264_nvenc": ["-preset", "p4", "-tune", "hq", "-rc", "vbr", "-cq", "19"],
+    "libx264": ["-preset", "ultrafast", "-crf", "23"],
+}
+
+
+def create_animated_media(images, output_filename, fps, mp4=False, video_encoders=("libx264",), threads=None, temp_dir=None):
+    # Use ffmpeg to create an animated gif or video from the images. Feed the
+    # frames through the concat demuxer in download order, which skips the
+    # directory scan and per-frame glob matching of -pattern_type glob
+    if temp_dir is None:
+        temp_dir = os.path.dirname(images[0])
+    list_path = os.path.join(temp_dir, "frames.txt")
+    with open(list_path, "w") as f:
+        f.writelines(f"file '{image}'\n" for image in images)
+    command = [
+        "ffmpeg",
+        "-loglevel",
+        "error",
+        "-nostats",
+        "-r",
+        str(fps),
+        "-f",
+        "concat",
+        "-safe",
+        "0",
+        "-i",
+        list_path,
+    ]
+
+    if mp4:
+        # Try hardware encoders first; fall back to software libx264
+        for encoder in video_encoders:
+            encode_command = command + [
+                "-pix_fmt",
+                "yuv420p",
+                "-c:v",
+                encoder,
+                "-movflags",
+                "faststart",
+            ]
+            encode_command += MP4_ENCODER_ARGS.get(encoder, [])
+            if threads:
+                encode_command += ["-threads", str(threads)]
+            encode_command += ["-y", output_filename]
+            try:
+                run_ffmpeg(encode_command)
+                return output_filename
+            except subprocess.CalledProcessError as e:
+                print(f"Error creating animated media with {encoder}: {e.stderr.decode()}")
+        return None
+
+    # Two-pass palette gif: generate a palette from the frames, then encode
+    # with it, which is both faster and higher quality than rgb8 output
+    palette_path = os.path.join(temp_dir, "palette.png")
+    try:
+        run_ffmpeg(
+            command + ["-vf", "palettegen=stats_mode=diff", "-y", palette_path]
+        )
+        run_ffmpeg(
+            command
+            + [
+                "-i",
+                palette_path,
+                "-lavfi",
+                "paletteuse=dither=bayer",
+                "-y",
+                output_filename,
+            ]
+        )
         return output_filename
     except subprocess.CalledProcessError as e:
-        print(f"Error creating animated media: {e}")
+        print(f"Error creating animated media: {e.stderr.decode()}")
         return None
 
 
 class Predictor(BasePredictor):
     def setup(self) -> None:
         """Load the model into memory to make running multiple predictions efficient"""
-        # Nothing to set up!
+        # Keep one event loop and one pooled HTTP session alive for the whole
+        # Predictor lifetime so connections are reused across predictions
+        try:
+            import uvloop
+
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
+        self._loop = asyncio.new_event_loop()
+        self._session = self._loop.run_until_complete(self._make_session())
+        # Probe once which H.264 encoders this ffmpeg build supports
+        self._video_encoders = probe_h264_encoders()
+        # Repeat URLs across predictions are served from this cache
+        self._url_cache = UrlCache()
+        # Thread count ffmpeg may use: the CPUs this container can actually
+        # run on, not the host count ffmpeg would auto-detect
+        self._ncpu = len(os.sched_getaffinity(0))
+        # One tmp root for the Predictor's lifetime; each predict gets a
+        # numbered subdir that is removed when the call finishes
+        self._tmp_root = tempfile.mkdtemp(prefix="cog-img2vid-")
+        self._call_id = itertools.count()
+
+    async def _make_session(self):
+        try:
+            # aiodns resolves on the loop instead of getaddrinfo's thread
+            # pool; one lookup per host covers a whole URL batch
+            resolver = aiohttp.AsyncResolver()
+        except RuntimeError:
+            resolver = None
+        self._connector = aiohttp.TCPConnector(
+            limit=64,
+            limit_per_host=8,
+            resolver=resolver,
+            use_dns_cache=True,
+            ttl_dns_cache=600,
+            keepalive_timeout=75,
+        )
+        # raise_for_status at the session level replaces the per-response
+        # calls; identity encoding skips pointless gzip negotiation on
+        # already-compressed image bytes
+        return aiohttp.ClientSession(
+            connector=self._connector,
+            raise_for_status=True,
+            headers={
+                "Accept-Encoding": "identity",
+                "User-Agent": "cog-img2vid/1",
+            },
+            skip_auto_headers=["User-Agent"],
+        )
+
+    def __del__(self):
+        # The loop and session live for the Predictor's whole lifetime;
+        # only tear them down when the Predictor itself goes away
+        if getattr(self, "_loop", None) is not None and not self._loop.is_closed():
+            if getattr(self, "_session", None) is not None:
+                self._loop.run_until_complete(self._session.close())
+            self._loop.close()
 
     def predict(
         self,
@@ -126,26 +410,61 @@ class Predictor(BasePredictor):
         ),
     ) -> Output:
         """Run a single prediction on the model"""
-        saved_images, temp_dir = asyncio.run(
-            save_images(image_urls.split(','))
-        )
-        print(saved_images, temp_dir)
-        output = Output(video=Path("."))
-        if saved_images and temp_dir:
-            output_filename = "animated.mp4" if mp4 else "animated.gif"
-            if os.path.exists(output_filename):
-                os.remove(output_filename)
-            create_animated_media(saved_images, output_filename, fps, mp4=mp4)
-            output = Output(video=Path(output_filename))
-            if output_zip:
-                zip_filename = "inputs.zip"
-                if os.path.exists(zip_filename):
-                    os.remove(zip_filename)
-                with ZipFile(zip_filename, "w") as zip:
-                    for file_path in Path(temp_dir).rglob("*"):
-                        zip.write(file_path, arcname=file_path.relative_to(temp_dir))
-                output.zip = Path(zip_filename)
-        return output
+        output_filename = "animated.mp4" if mp4 else "animated.gif"
+        if os.path.exists(output_filename):
+            os.remove(output_filename)
+        temp_dir = os.path.join(self._tmp_root, str(next(self._call_id)))
+        os.mkdir(temp_dir)
+        try:
+            if mp4:
+                # Pipe frames straight into the encoder as downloads complete
+                saved_images, encoded = self._loop.run_until_complete(
+                    save_images_and_encode(
+                        self._session,
+                        iter_urls(image_urls),
+                        temp_dir,
+                        output_filename,
+                        fps,
+                        self._video_encoders,
+                        url_cache=self._url_cache,
+                        threads=self._ncpu,
+                    )
+                )
+            else:
+                saved_images = self._loop.run_until_complete(
+                    save_images(
+                        self._session,
+                        iter_urls(image_urls),
+                        temp_dir,
+                        url_cache=self._url_cache,
+                    )
+                )
+                encoded = False
+            print(saved_images, temp_dir)
+            output = Output(video=Path("."))
+            if saved_images:
+                if not encoded:
+                    create_animated_media(
+                        saved_images,
+                        output_filename,
+                        fps,
+                        mp4=mp4,
+                        video_encoders=self._video_encoders,
+                        threads=self._ncpu,
+                        temp_dir=temp_dir,
+                    )
+                output = Output(video=Path(output_filename))
+                if output_zip:
+                    zip_filename = "inputs.zip"
+                    if os.path.exists(zip_filename):
+                        os.remove(zip_filename)
+                    write_zip(zip_filename, saved_images)
+                    output.zip = Path(zip_filename)
+            return output
+        finally:
+            # Frames are no longer needed once the video and zip exist;
+            # without this, tmpfs grows without bound across predictions
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
 if __name__ == "__main__":
     p = Predictor()